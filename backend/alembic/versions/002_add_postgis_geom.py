@@ -0,0 +1,63 @@
+"""Add PostGIS geometry column and GiST index to trees
+
+Revision ID: 002
+Revises: 001
+Create Date: 2025-11-20 12:00:00.000000
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+import geoalchemy2
+
+
+# revision identifiers, used by Alembic.
+revision: str = '002'
+down_revision: Union[str, None] = '001'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.execute("CREATE EXTENSION IF NOT EXISTS postgis")
+
+    op.add_column(
+        'trees',
+        sa.Column(
+            'geom',
+            geoalchemy2.Geometry(geometry_type='POINT', srid=4326, spatial_index=False),
+            nullable=True,
+        ),
+    )
+    op.execute(
+        "UPDATE trees SET geom = ST_SetSRID(ST_MakePoint(longitude, latitude), 4326)"
+    )
+    op.execute("CREATE INDEX ix_trees_geom ON trees USING GIST (geom)")
+
+    # Keep geom in sync with latitude/longitude for every write path
+    # (single inserts, bulk inserts and manual updates alike).
+    op.execute(
+        """
+        CREATE OR REPLACE FUNCTION trees_set_geom() RETURNS trigger AS $$
+        BEGIN
+            NEW.geom := ST_SetSRID(ST_MakePoint(NEW.longitude, NEW.latitude), 4326);
+            RETURN NEW;
+        END;
+        $$ LANGUAGE plpgsql
+        """
+    )
+    op.execute(
+        """
+        CREATE TRIGGER trees_set_geom
+        BEFORE INSERT OR UPDATE OF latitude, longitude ON trees
+        FOR EACH ROW EXECUTE FUNCTION trees_set_geom()
+        """
+    )
+
+
+def downgrade() -> None:
+    op.execute("DROP TRIGGER IF EXISTS trees_set_geom ON trees")
+    op.execute("DROP FUNCTION IF EXISTS trees_set_geom()")
+    op.execute("DROP INDEX IF EXISTS ix_trees_geom")
+    op.drop_column('trees', 'geom')
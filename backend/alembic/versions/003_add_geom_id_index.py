@@ -0,0 +1,31 @@
+"""Replace the geom GiST index with a composite (geom, id) index
+
+Revision ID: 003
+Revises: 002
+Create Date: 2025-11-21 12:00:00.000000
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision: str = '003'
+down_revision: Union[str, None] = '002'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    # btree_gist lets the integer id live in the same GiST index as geom,
+    # so keyset pages (geom && envelope AND id > :after_id) are answered
+    # from one index scan
+    op.execute("CREATE EXTENSION IF NOT EXISTS btree_gist")
+    op.execute("CREATE INDEX ix_trees_geom_id ON trees USING GIST (geom, id)")
+    op.execute("DROP INDEX IF EXISTS ix_trees_geom")
+
+
+def downgrade() -> None:
+    op.execute("CREATE INDEX ix_trees_geom ON trees USING GIST (geom)")
+    op.execute("DROP INDEX IF EXISTS ix_trees_geom_id")
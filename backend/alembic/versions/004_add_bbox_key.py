@@ -0,0 +1,71 @@
+"""Add Morton-ordered bbox_key column to trees
+
+Revision ID: 004
+Revises: 003
+Create Date: 2025-11-24 12:00:00.000000
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '004'
+down_revision: Union[str, None] = '003'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    # Must stay in sync with app.models.morton_key
+    op.execute(
+        """
+        CREATE OR REPLACE FUNCTION trees_morton_key(lat double precision, lon double precision)
+        RETURNS bigint AS $$
+        DECLARE
+            x bigint := floor((lon + 180) * 100000);
+            y bigint := floor((lat + 90) * 100000);
+            key bigint := 0;
+        BEGIN
+            FOR i IN 0..25 LOOP
+                key := key | (((x >> i) & 1) << (2 * i)) | (((y >> i) & 1) << (2 * i + 1));
+            END LOOP;
+            RETURN key;
+        END;
+        $$ LANGUAGE plpgsql IMMUTABLE
+        """
+    )
+
+    op.add_column('trees', sa.Column('bbox_key', sa.BigInteger(), nullable=True))
+    op.execute("UPDATE trees SET bbox_key = trees_morton_key(latitude, longitude)")
+    op.create_index(op.f('ix_trees_bbox_key'), 'trees', ['bbox_key'], unique=False)
+
+    op.execute(
+        """
+        CREATE OR REPLACE FUNCTION trees_set_geom() RETURNS trigger AS $$
+        BEGIN
+            NEW.geom := ST_SetSRID(ST_MakePoint(NEW.longitude, NEW.latitude), 4326);
+            NEW.bbox_key := trees_morton_key(NEW.latitude, NEW.longitude);
+            RETURN NEW;
+        END;
+        $$ LANGUAGE plpgsql
+        """
+    )
+
+
+def downgrade() -> None:
+    op.execute(
+        """
+        CREATE OR REPLACE FUNCTION trees_set_geom() RETURNS trigger AS $$
+        BEGIN
+            NEW.geom := ST_SetSRID(ST_MakePoint(NEW.longitude, NEW.latitude), 4326);
+            RETURN NEW;
+        END;
+        $$ LANGUAGE plpgsql
+        """
+    )
+    op.drop_index(op.f('ix_trees_bbox_key'), table_name='trees')
+    op.drop_column('trees', 'bbox_key')
+    op.execute("DROP FUNCTION IF EXISTS trees_morton_key(double precision, double precision)")
@@ -0,0 +1,29 @@
+"""Add composite (latitude, longitude) btree index to trees
+
+Revision ID: 005
+Revises: 004
+Create Date: 2025-11-25 12:00:00.000000
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision: str = '005'
+down_revision: Union[str, None] = '004'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    # Plain btree range scan for the latitude/longitude BETWEEN predicates;
+    # check the plan with
+    #   EXPLAIN (ANALYZE, BUFFERS) SELECT * FROM trees
+    #   WHERE latitude BETWEEN ... AND longitude BETWEEN ...
+    op.create_index('ix_trees_lat_lon', 'trees', ['latitude', 'longitude'], unique=False)
+
+
+def downgrade() -> None:
+    op.drop_index('ix_trees_lat_lon', table_name='trees')
@@ -0,0 +1,46 @@
+import time
+from collections import OrderedDict
+from threading import Lock
+
+
+class ResponseCache:
+    """In-process LRU cache of serialized responses with a TTL.
+
+    Entries are keyed together with a generation counter: invalidate()
+    bumps the counter so every existing entry becomes unreachable and ages
+    out of the LRU. Each worker process holds its own cache, so writes
+    handled by another worker are picked up once the TTL expires.
+    """
+
+    def __init__(self, maxsize: int = 4096, ttl: float = 60.0):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.generation = 0
+        self._entries: OrderedDict = OrderedDict()
+        self._lock = Lock()
+
+    def key(self, *parts) -> tuple:
+        return (self.generation, *parts)
+
+    def get(self, key: tuple) -> bytes | None:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            expires_at, value = entry
+            if expires_at < time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key: tuple, value: bytes) -> None:
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def invalidate(self) -> None:
+        with self._lock:
+            self.generation += 1
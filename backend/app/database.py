@@ -1,6 +1,7 @@
-from sqlalchemy import create_engine
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import NullPool
 import os
 
 DATABASE_URL = os.getenv(
@@ -8,15 +9,38 @@ DATABASE_URL = os.getenv(
     "postgresql://postgres:postgres@db:5432/trees_db"
 )
 
-engine = create_engine(DATABASE_URL)
-SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+# DATABASE_URL is shared with Alembic, which stays on psycopg2; the app
+# talks to PostgreSQL through asyncpg
+ASYNC_DATABASE_URL = make_url(DATABASE_URL).set(drivername="postgresql+asyncpg")
+
+if os.getenv("PGBOUNCER_ENABLED", "false").lower() == "true":
+    # PgBouncer (transaction pooling, port 6432) owns the connection pool,
+    # so the app opens and releases a server connection per checkout.
+    # Prepared statements do not survive transaction pooling.
+    engine = create_async_engine(
+        ASYNC_DATABASE_URL,
+        poolclass=NullPool,
+        connect_args={"statement_cache_size": 0, "prepared_statement_cache_size": 0},
+    )
+else:
+    engine = create_async_engine(
+        ASYNC_DATABASE_URL,
+        pool_size=20,
+        max_overflow=10,
+        pool_timeout=30,
+        pool_pre_ping=True,
+        pool_recycle=3600,
+    )
+AsyncSessionLocal = async_sessionmaker(engine, autoflush=False, expire_on_commit=False)
 
 Base = declarative_base()
 
 
-def get_db():
-    db = SessionLocal()
-    try:
+async def get_db():
+    """Yield a short-lived AsyncSession for a single request.
+
+    The Session is closed when the request finishes, returning its
+    connection to the pool (or to PgBouncer) right away.
+    """
+    async with AsyncSessionLocal() as db:
         yield db
-    finally:
-        db.close()
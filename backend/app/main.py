@@ -1,11 +1,29 @@
-from fastapi import FastAPI, Depends, HTTPException
+import logging
+import math
+import os
+
+import orjson
+from fastapi import FastAPI, Depends, HTTPException, Response
 from fastapi.middleware.cors import CORSMiddleware
-from sqlalchemy.orm import Session
+from fastapi.responses import ORJSONResponse, StreamingResponse
+from sqlalchemy import func, insert, select
+from sqlalchemy.ext.asyncio import AsyncSession
 from typing import List
-from app.database import get_db
-from app.models import Tree, TreeCreate, TreeDB
+from app.cache import ResponseCache
+from app.database import engine, get_db
+from app.models import Tree, TreeBulkResult, TreeCreate, TreeDB, morton_key
+
+logger = logging.getLogger(__name__)
+
+IS_DEV = os.getenv("ENV") == "development"
 
-app = FastAPI(title="Tree Detection API", version="1.0.0")
+# orjson serializes the remaining (non-streamed) responses; Pydantic models
+# are kept on the write paths only, where request input needs validating
+app = FastAPI(
+    title="Tree Detection API",
+    version="1.0.0",
+    default_response_class=ORJSONResponse,
+)
 
 # Configure CORS to accept requests from all origins
 app.add_middleware(
@@ -22,38 +40,134 @@ def root():
     return {"message": "Tree Detection API - Use /trees endpoint"}
 
 
-@app.get("/trees", response_model=List[Tree])
-def get_trees(
+# Rows are streamed straight from a server-side cursor, so the API never
+# hydrates ORM objects or re-validates them with Pydantic on the read path,
+# and memory stays bounded by one batch regardless of the bbox size.
+STREAM_BATCH_SIZE = 1000
+
+# Map clients mostly request viewports on the same zoom/tile boundaries, so
+# bboxes are snapped outwards to a 0.001 deg grid and the serialized response
+# is cached for a minute
+BBOX_QUANTUM = 1000
+trees_cache = ResponseCache(maxsize=4096, ttl=60.0)
+
+TREE_COLUMNS = (
+    TreeDB.id,
+    TreeDB.latitude,
+    TreeDB.longitude,
+    TreeDB.source_file,
+    TreeDB.bbox_xmin,
+    TreeDB.bbox_ymin,
+    TreeDB.bbox_xmax,
+    TreeDB.bbox_ymax,
+)
+
+
+def quantize_down(value: float | None) -> float | None:
+    return None if value is None else math.floor(value * BBOX_QUANTUM) / BBOX_QUANTUM
+
+
+def quantize_up(value: float | None) -> float | None:
+    return None if value is None else math.ceil(value * BBOX_QUANTUM) / BBOX_QUANTUM
+
+
+async def stream_trees(stmt, cache_key: tuple):
+    """Yield the rows selected by stmt as the chunks of a JSON array.
+
+    The complete body is stored in trees_cache under cache_key once the
+    last chunk has been produced.
+    """
+    chunks = [b"["]
+    yield chunks[0]
+    # The request's Session is already closed while the body streams,
+    # so the generator owns its connection
+    async with engine.connect() as conn:
+        result = await conn.stream(stmt.execution_options(yield_per=STREAM_BATCH_SIZE))
+        async for partition in result.mappings().partitions():
+            if len(chunks) > 1:
+                chunks.append(b",")
+                yield b","
+            chunk = b",".join(orjson.dumps(dict(row)) for row in partition)
+            chunks.append(chunk)
+            yield chunk
+    chunks.append(b"]")
+    yield b"]"
+    trees_cache.set(cache_key, b"".join(chunks))
+
+
+@app.get("/trees", responses={200: {"model": List[Tree]}})
+async def get_trees(
     min_lat: float = None,
     max_lat: float = None,
     min_lon: float = None,
     max_lon: float = None,
+    after_id: int = None,
     limit: int = 100,
-    db: Session = Depends(get_db)
 ):
-    query = db.query(TreeDB)
+    min_lat, min_lon = quantize_down(min_lat), quantize_down(min_lon)
+    max_lat, max_lon = quantize_up(max_lat), quantize_up(max_lon)
 
-    if min_lat is not None:
-        query = query.filter(TreeDB.latitude >= min_lat)
-    if max_lat is not None:
-        query = query.filter(TreeDB.latitude <= max_lat)
-    if min_lon is not None:
-        query = query.filter(TreeDB.longitude >= min_lon)
-    if max_lon is not None:
-        query = query.filter(TreeDB.longitude <= max_lon)
+    cache_key = trees_cache.key(min_lat, max_lat, min_lon, max_lon, after_id, limit)
+    cached = trees_cache.get(cache_key)
+    if cached is not None:
+        return Response(content=cached, media_type="application/json")
 
-    trees = query.limit(limit).all()
-    print(f"Retrieved {len(trees)} trees from the database.")
-    return trees
+    # Keyset pagination: pass the last id of the previous page as after_id
+    stmt = select(*TREE_COLUMNS).order_by(TreeDB.id).limit(limit)
+
+    if any(v is not None for v in (min_lat, max_lat, min_lon, max_lon)):
+        # Missing bounds fall back to the full WGS 84 extent so the filter
+        # can always be answered by the GiST index on geom. Given bounds are
+        # clamped to it too: morton_key is only monotonic on that extent, and
+        # an out-of-range corner would give a key range matching no tree
+        bounds = (
+            max(min_lon, -180.0) if min_lon is not None else -180.0,
+            max(min_lat, -90.0) if min_lat is not None else -90.0,
+            min(max_lon, 180.0) if max_lon is not None else 180.0,
+            min(max_lat, 90.0) if max_lat is not None else 90.0,
+        )
+        # Cheap btree range scan on the Z-order key first; it admits false
+        # positives, which the exact envelope test then removes
+        stmt = stmt.where(
+            TreeDB.bbox_key.between(
+                morton_key(bounds[1], bounds[0]),
+                morton_key(bounds[3], bounds[2]),
+            )
+        )
+        stmt = stmt.where(TreeDB.geom.intersects(func.ST_MakeEnvelope(*bounds, 4326)))
+        # Same bbox on the raw columns, so the planner can also pick the
+        # (latitude, longitude) btree index
+        stmt = stmt.where(
+            TreeDB.latitude.between(bounds[1], bounds[3]),
+            TreeDB.longitude.between(bounds[0], bounds[2]),
+        )
+    if after_id is not None:
+        stmt = stmt.where(TreeDB.id > after_id)
+
+    logger.debug("Streaming trees for %s", stmt)
+    return StreamingResponse(stream_trees(stmt, cache_key), media_type="application/json")
 
 
 @app.post("/trees", response_model=Tree, status_code=201)
-def create_tree(tree: TreeCreate, db: Session = Depends(get_db)):
-    import os
-    if os.getenv("ENV") != "development":
+async def create_tree(tree: TreeCreate, db: AsyncSession = Depends(get_db)):
+    if not IS_DEV:
         raise HTTPException(status_code=403, detail="Tree creation is not allowed in production environment.")
     db_tree = TreeDB(**tree.model_dump())
     db.add(db_tree)
-    db.commit()
-    db.refresh(db_tree)
+    await db.commit()
+    await db.refresh(db_tree)
+    trees_cache.invalidate()
     return db_tree
+
+
+@app.post("/trees/bulk", response_model=TreeBulkResult, status_code=201)
+async def create_trees_bulk(trees: List[TreeCreate], db: AsyncSession = Depends(get_db)):
+    if not IS_DEV:
+        raise HTTPException(status_code=403, detail="Tree creation is not allowed in production environment.")
+    if trees:
+        # One batched INSERT ... VALUES statement instead of a round-trip and
+        # flush per tree; the rows are not read back
+        await db.execute(insert(TreeDB), [tree.model_dump() for tree in trees])
+        await db.commit()
+        trees_cache.invalidate()
+    return TreeBulkResult(created=len(trees))
@@ -1,7 +1,30 @@
-from sqlalchemy import Column, Integer, String, Float
+import math
+
+from sqlalchemy import BigInteger, Column, Index, Integer, String, Float
+from geoalchemy2 import Geometry
 from pydantic import BaseModel
 from app.database import Base
 
+# Coordinates are stored on a 1e-5 deg grid (~1 m), shifted to be
+# non-negative; 26 bits per axis cover the full WGS 84 extent
+MORTON_SCALE = 100000
+MORTON_BITS = 26
+
+
+def morton_key(lat: float, lon: float) -> int:
+    """Interleave the grid cell of (lat, lon) into a Z-order key.
+
+    Mirrors the trees_morton_key SQL function that fills TreeDB.bbox_key.
+    The key is monotonic in both coordinates, so every point inside a bbox
+    has a key between the keys of its south-west and north-east corners.
+    """
+    x = math.floor((lon + 180) * MORTON_SCALE)
+    y = math.floor((lat + 90) * MORTON_SCALE)
+    key = 0
+    for i in range(MORTON_BITS):
+        key |= ((x >> i) & 1) << (2 * i) | ((y >> i) & 1) << (2 * i + 1)
+    return key
+
 
 class TreeDB(Base):
     __tablename__ = "trees"
@@ -14,6 +37,14 @@ class TreeDB(Base):
     bbox_ymin = Column(Integer, nullable=False)
     bbox_xmax = Column(Integer, nullable=False)
     bbox_ymax = Column(Integer, nullable=False)
+    # Populated from latitude/longitude by the trees_set_geom trigger
+    geom = Column(Geometry(geometry_type="POINT", srid=4326, spatial_index=False))
+    bbox_key = Column(BigInteger, index=True)
+
+    __table_args__ = (
+        Index("ix_trees_geom_id", "geom", "id", postgresql_using="gist"),
+        Index("ix_trees_lat_lon", "latitude", "longitude"),
+    )
 
 
 class TreeCreate(BaseModel):
@@ -38,3 +69,7 @@ class Tree(BaseModel):
 
     class Config:
         from_attributes = True
+
+
+class TreeBulkResult(BaseModel):
+    created: int
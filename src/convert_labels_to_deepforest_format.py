@@ -1,7 +1,15 @@
-import xml.etree.ElementTree as ET
 import csv
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
 
+from lxml import etree
+
+FIELDNAMES = ['image_path', 'xmin', 'ymin', 'xmax', 'ymax', 'label']
+
+# Built once and reused for every file (one copy per worker process);
+# annotations never use IDs or entities
+_PARSER = etree.XMLParser(remove_blank_text=True, collect_ids=False, resolve_entities=False)
+
 
 def parse_pascal_voc_xml(xml_path):
     """
@@ -11,40 +19,37 @@ def parse_pascal_voc_xml(xml_path):
         xml_path: Path to the XML file
         
     Returns:
-        List of dictionaries containing annotation data
+        List of (image_path, xmin, ymin, xmax, ymax, label) tuples,
+        in FIELDNAMES order
     """
-    tree = ET.parse(xml_path)
-    root = tree.getroot()
-    
-    # Get the filename
-    filename = root.find('filename').text
-    
+    root = etree.fromstring(Path(xml_path).read_bytes(), _PARSER)
+    filename = root.findtext('filename')
     annotations = []
     
-    # Iterate through all objects in the XML
-    for obj in root.findall('object'):
+    for obj in root.iterfind('object'):
         # Get the label name
-        label = obj.find('name').text
+        label = obj.findtext('name')
         
-        # Get bounding box coordinates
-        bndbox = obj.find('bndbox')
-        xmin = int(bndbox.find('xmin').text)
-        ymin = int(bndbox.find('ymin').text)
-        xmax = int(bndbox.find('xmax').text)
-        ymax = int(bndbox.find('ymax').text)
+        # Get bounding box coordinates in one pass over <bndbox>
+        coords = {child.tag: child.text for child in obj.find('bndbox')}
+        xmin = int(coords['xmin'])
+        ymin = int(coords['ymin'])
+        xmax = int(coords['xmax'])
+        ymax = int(coords['ymax'])
         
-        annotations.append({
-            'image_path': filename,
-            'xmin': xmin,
-            'ymin': ymin,
-            'xmax': xmax,
-            'ymax': ymax,
-            'label': label
-        })
+        annotations.append((filename, xmin, ymin, xmax, ymax, label))
     
     return annotations
 
 
+def _parse_pascal_voc_xml_safe(xml_path):
+    """Worker wrapper returning (annotations, error) so one bad file does not abort the pool."""
+    try:
+        return parse_pascal_voc_xml(xml_path), None
+    except Exception as e:
+        return [], e
+
+
 def convert_annotations_to_deepforest_csv(annotations_dir, output_csv):
     """
     Convert all Pascal VOC XML annotations to DeepForest CSV format.
@@ -67,21 +72,22 @@ def convert_annotations_to_deepforest_csv(annotations_dir, output_csv):
     # Collect all annotations
     all_annotations = []
     
-    for xml_file in xml_files:
-        try:
-            annotations = parse_pascal_voc_xml(xml_file)
+    # XML parsing is CPU-bound, so spread the files across processes
+    with ProcessPoolExecutor() as executor:
+        results = executor.map(_parse_pascal_voc_xml_safe, xml_files, chunksize=32)
+        for xml_file, (annotations, error) in zip(xml_files, results):
+            if error is not None:
+                print(f"Error processing {xml_file.name}: {error}")
+                continue
             all_annotations.extend(annotations)
             print(f"Processed {xml_file.name}: {len(annotations)} annotations")
-        except Exception as e:
-            print(f"Error processing {xml_file.name}: {e}")
     
     # Write to CSV
     if all_annotations:
         with open(output_csv, 'w', newline='') as csvfile:
-            fieldnames = ['image_path', 'xmin', 'ymin', 'xmax', 'ymax', 'label']
-            writer = csv.DictWriter(csvfile, fieldnames=fieldnames)
+            writer = csv.writer(csvfile)
             
-            writer.writeheader()
+            writer.writerow(FIELDNAMES)
             writer.writerows(all_annotations)
         
         print(f"\nSuccessfully wrote {len(all_annotations)} annotations to {output_csv}")
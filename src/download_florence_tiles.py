@@ -1,23 +1,42 @@
-import requests
+import asyncio
+import logging
+from dataclasses import dataclass
+import httpx
+import numpy as np
+from pathlib import Path
+from tqdm import tqdm
 from typing import List
-from concurrent.futures import ThreadPoolExecutor
-from copy import deepcopy
 
+logger = logging.getLogger(__name__)
 
+# Upper bound on in-flight GetMap requests, to avoid overwhelming the
+# provincial WMS server
+MAX_CONCURRENT_DOWNLOADS = 16
+
+# Per-tile retries on top of the transport's connection retries; the delay
+# doubles after every failed attempt
+MAX_TILE_RETRIES = 3
+RETRY_BACKOFF_S = 0.5
+
+
+class WMSError(Exception):
+    """The WMS server answered with something other than a GeoTIFF."""
+
+
+@dataclass(slots=True, frozen=True)
 class Point:
-    def __init__(self, x, y):
-        self.x = x
-        self.y = y
+    x: float
+    y: float
 
     def __str__(self):
         return f"point_{self.x}_{self.y}"
 
 
+@dataclass(slots=True, frozen=True)
 class Tile:
-    def __init__(self, point: Point, bbox_step: int = 80, prefix: str = "data/01_raw/florence"):
-        self.point = point
-        self.bbox_step = bbox_step
-        self.prefix = prefix
+    point: Point
+    bbox_step: int = 80
+    prefix: str = "data/01_raw/florence"
 
     def __str__(self):
         return f"{self.point}"
@@ -26,11 +45,11 @@ class Tile:
     def bbox(self):
         return self.coordinates_to_bbox(self.point, self.bbox_step)
 
-    def download(self, output_file: str | None = None):
+    async def download(self, client: httpx.AsyncClient, output_file: str | None = None):
         if output_file is None:
             output_file = f"zz_23_{self.point.x}_{self.point.y}.tif"
 
-        get_wms_geotiff(self.bbox, f"{self.prefix}/{output_file}")
+        await get_wms_geotiff(client, self.bbox, f"{self.prefix}/{output_file}")
 
     @classmethod
     def coordinates_to_bbox(cls, point: Point, step=80) -> list:
@@ -48,7 +67,8 @@ class Tile:
         ]
 
 
-def get_wms_geotiff(
+async def get_wms_geotiff(
+    client: httpx.AsyncClient,
     bbox: List[float],
     output_filepath: str,
     layer: str = "rt_ofc.5k23.32bit", #for 2024/25 photos use -> "rt_ofc.5k24.32bit",
@@ -61,6 +81,8 @@ def get_wms_geotiff(
     Downloads a GeoTIFF tile from a WMS service given a bounding box.
 
     Args:
+        client (httpx.AsyncClient): The client used for the request; tiles
+                                    share its HTTP/2 connection.
         bbox (List[float]): The bounding box for the tile in the format
                             [minX, minY, maxX, maxY]. The coordinates must
                             be in the same CRS specified by the 'crs' param.
@@ -76,6 +98,11 @@ def get_wms_geotiff(
                              Defaults to 'EPSG:25832'.
         base_url (str, optional): The base URL of the WMS service.
                                   Defaults to the Regione Toscana service.
+
+    Raises:
+        httpx.HTTPError: If the request fails or the server returns an
+                         HTTP error status.
+        WMSError: If the server does not return a GeoTIFF.
     """
 
     # Convert the bounding box list to the comma-separated string
@@ -99,40 +126,28 @@ def get_wms_geotiff(
         "TRANSPARENT": "true",
     }
 
-    print(f"Requesting 800x800 GeoTIFF for BBOX: {bbox_str}...")
+    logger.debug("Requesting 800x800 GeoTIFF for BBOX: %s", bbox_str)
 
-    try:
-        # Make the HTTP GET request
-        response = requests.get(base_url, params=params)
+    # Make the HTTP GET request
+    response = await client.get(base_url, params=params)
 
-        # This will raise an exception if the server returns an HTTP error
-        # (e.g., 404, 500)
-        response.raise_for_status()
+    # This will raise an exception if the server returns an HTTP error
+    # (e.g., 404, 500)
+    response.raise_for_status()
 
-        # Check if the server returned a GeoTIFF or an error message
-        # WMS errors are often returned as XML or text
-        content_type = response.headers.get("Content-Type")
+    # Check if the server returned a GeoTIFF or an error message
+    # WMS errors are often returned as XML or text
+    content_type = response.headers.get("Content-Type", "")
 
-        if "image/tiff" in content_type:
-            # Save the image content to the specified file
-            with open(output_filepath, "wb") as f:
-                f.write(response.content)
-            print(f"Successfully downloaded tile to: {output_filepath}")
+    if "image/tiff" not in content_type:
+        raise WMSError(
+            f"Server did not return a GeoTIFF (Content-Type: {content_type}): "
+            f"{response.text[:500]}"
+        )
 
-        else:
-            # The server returned something other than a GeoTIFF
-            # (likely an error message)
-            print("Error: Server did not return a GeoTIFF.")
-            print(f"Response Content-Type: {content_type}")
-            print(f"Server Response (first 500 chars):\n{response.text[:500]}...")
-
-    except requests.exceptions.HTTPError as e:
-        # Handle HTTP errors (e.g., 404 Not Found, 500 Internal Server Error)
-        print(f"HTTP Error: {e}")
-        print(f"Response text: {response.text}")
-    except requests.exceptions.RequestException as e:
-        # Handle other network-related errors (e.g., connection error)
-        print(f"An error occurred: {e}")
+    # Save the image content to the specified file off the event loop
+    await asyncio.to_thread(Path(output_filepath).write_bytes, response.content)
+    logger.debug("Successfully downloaded tile to: %s", output_filepath)
 
 
 def download_florence_tiles(start: Point, end: Point):
@@ -143,22 +158,62 @@ def download_florence_tiles(start: Point, end: Point):
     """
     step_in_m = 80
 
-    current = deepcopy(start)
+    # Row-major grid of tile centers, bottom row first
+    xs = np.arange(start.x, end.x, step_in_m)
+    ys = np.arange(start.y, end.y, step_in_m)
+    xx, yy = np.meshgrid(xs, ys)
+    coords = np.column_stack([xx.ravel(), yy.ravel()])
+
+    tiles_to_download: list[Tile] = [
+        Tile(Point(float(x), float(y))) for x, y in coords
+    ]
 
-    tiles_to_download: list[Tile] = []
+    asyncio.run(download_tiles(tiles_to_download))
 
-    while current.y < end.y:
-        while current.x < end.x:
-            tiles_to_download.append(Tile(Point(current.x, current.y)))
-            current.x = current.x + step_in_m
-        current.y = current.y + step_in_m
-        current.x = start.x
 
-    with ThreadPoolExecutor(max_workers=10) as executor:
-        executor.map(lambda t: t.download(), tiles_to_download)
+async def download_tiles(tiles: list[Tile]):
+    """Download all tiles over a single multiplexed HTTP/2 client.
+
+    Failed tiles are retried with exponential backoff; tiles that still fail
+    are logged and counted instead of being dropped silently.
+    """
+    semaphore = asyncio.Semaphore(MAX_CONCURRENT_DOWNLOADS)
+
+    async def download_one(client: httpx.AsyncClient, tile: Tile):
+        for attempt in range(MAX_TILE_RETRIES + 1):
+            try:
+                async with semaphore:
+                    await tile.download(client)
+                return
+            except (httpx.HTTPError, WMSError) as e:
+                if attempt == MAX_TILE_RETRIES:
+                    raise RuntimeError(f"{tile}: {e}") from e
+                await asyncio.sleep(RETRY_BACKOFF_S * 2**attempt)
+
+    # Connection-level options live on the transport, which also retries
+    # failed connection attempts
+    transport = httpx.AsyncHTTPTransport(
+        http2=True,
+        retries=3,
+        limits=httpx.Limits(max_connections=32),
+    )
+    failed = 0
+    async with httpx.AsyncClient(transport=transport, timeout=60) as client:
+        downloads = [download_one(client, t) for t in tiles]
+        for download in tqdm(asyncio.as_completed(downloads), total=len(downloads)):
+            try:
+                await download
+            except Exception as e:
+                failed += 1
+                logger.warning("Tile failed: %s", e)
+
+    if failed:
+        logger.warning("%d of %d tiles failed to download", failed, len(tiles))
 
 
 if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+
     start_point = Point(674048.64,4852250.78)
     end_point = Point(675960.26,4853751.03)
 
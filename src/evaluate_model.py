@@ -1,9 +1,8 @@
 from dataclasses import dataclass, asdict
-import torch
 import argparse
 from pathlib import Path
-from deepforest import main
 from config import load_config
+from forest_model import DeepForest, load_weights
 import pandas as pd
 import numpy as np
 import json
@@ -42,10 +41,13 @@ def evaluate(model_path: Path | None):
         print(f"Error: Test annotations file not found at {test_annotations_path}")
         return
 
-    model = main.deepforest()
+    model = DeepForest()
+    # Batch the test images through the network instead of one per forward pass
+    model.config["batch_size"] = evaluation_config.get("batch_size", 1)
+    model.config["workers"] = evaluation_config.get("workers", 0)
     if model_path:
         print(f"Loading fine-tuned model from {model_path}...")
-        model.model = torch.load(model_path, weights_only=False)
+        load_weights(model, model_path)
         model.config["score_thresh"] = evaluation_config["score_thresh"]
     else:
         print("Loading the pretrained model")
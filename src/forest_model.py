@@ -0,0 +1,104 @@
+"""
+DeepForest model tweaks shared by the training, evaluation and prediction
+scripts.
+"""
+
+import pickle
+
+import torch
+from deepforest import main
+
+
+def load_weights(model: main.deepforest, path) -> None:
+    """
+    Load fine-tuned weights saved by train_model.save_model into model.model.
+
+    Models are saved as a state_dict and loaded with the restricted
+    weights_only unpickler. Older files pickled the whole RetinaNet module;
+    they can only be read with the full unpickler, so only open those from
+    trusted sources.
+    """
+    try:
+        state_dict = torch.load(path, map_location="cpu", weights_only=True)
+    except pickle.UnpicklingError:
+        # Legacy file holding the full nn.Module
+        model.model = torch.load(path, map_location="cpu", weights_only=False)
+        return
+    model.model.load_state_dict(state_dict)
+
+
+def save_weights(model: main.deepforest, path) -> None:
+    """
+    Save model.model's state_dict. torch.compile'd submodules prefix their
+    keys with "_orig_mod."; that is stripped so the file loads into a plain
+    model.
+    """
+    state_dict = {
+        key.replace("_orig_mod.", ""): value
+        for key, value in model.model.state_dict().items()
+    }
+    torch.save(state_dict, path)
+
+
+def list_collate(batch):
+    """Collate images into a list instead of stacking them into one tensor."""
+    return list(batch)
+
+
+class DeepForest(main.deepforest):
+    """
+    deepforest.main.deepforest with a prediction dataloader that can batch
+    images of different sizes, and training/validation dataloaders that
+    honour DataLoader options deepforest's config does not expose.
+
+    The stock predict_dataloader relies on default_collate, which stacks the
+    images and therefore only works with batch_size=1 when image sizes differ.
+    Collating into a list lets torchvision's RetinaNet transform pad and batch
+    the images itself, so predict_file/evaluate run one forward pass per batch.
+
+    Extra config["train"] keys:
+        pin_memory: page-locked batches, so Lightning's non_blocking
+                    host-to-device copies overlap with compute (CUDA only)
+        persistent_workers: keep the worker processes alive between epochs
+                            instead of re-spawning them (needs workers > 0)
+        scheduler.monitor: metric the LR scheduler watches; deepforest
+                           always uses val_classification
+    """
+
+    def configure_optimizers(self):
+        optimizers = super().configure_optimizers()
+        monitor = self.config["train"].get("scheduler", {}).get("monitor")
+        if monitor and isinstance(optimizers, dict) and "monitor" in optimizers:
+            optimizers["monitor"] = monitor
+        return optimizers
+
+    def load_dataset(self, csv_file, root_dir=None, augment=False, shuffle=True, batch_size=1, train=False):
+        loader = super().load_dataset(
+            csv_file,
+            root_dir=root_dir,
+            augment=augment,
+            shuffle=shuffle,
+            batch_size=batch_size,
+            train=train,
+        )
+        # Same dataset and collate, rebuilt with the options deepforest
+        # does not pass through
+        return torch.utils.data.DataLoader(
+            loader.dataset,
+            batch_size=batch_size,
+            shuffle=shuffle,
+            collate_fn=loader.collate_fn,
+            num_workers=loader.num_workers,
+            pin_memory=self.config["train"].get("pin_memory", False) and torch.cuda.is_available(),
+            persistent_workers=self.config["train"].get("persistent_workers", False) and loader.num_workers > 0,
+        )
+
+    def predict_dataloader(self, ds):
+        return torch.utils.data.DataLoader(
+            ds,
+            batch_size=self.config["batch_size"],
+            shuffle=False,
+            num_workers=self.config["workers"],
+            collate_fn=list_collate,
+            pin_memory=torch.cuda.is_available(),
+        )
@@ -1,33 +1,56 @@
 import os
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path 
 import random
 
 base_path = Path("data/02_processed")
-source_images = os.listdir(base_path / "label_studio_export/images")
-source_annotations = os.listdir(base_path / "label_studio_export/Annotations")
     
 
-def move_files(annotations, dest):
+def _move(src, dst):
+    """os.replace that, like a move, refuses to overwrite an existing file."""
+    if os.path.exists(dst):
+        raise FileExistsError(f"Destination already exists: {dst}")
+    os.replace(src, dst)
+
+
+def move_files(annotations, dest, images=None):
+    """
+    Move the given annotations and their images into `dest`.
+
+    `images` is the set of file names in the export's images folder; pass
+    it in when splitting into several destinations to list the folder once.
+    """
     
     os.mkdir(dest / "annotations")
     os.mkdir(dest / "images")
     
+    if images is None:
+        images = set(os.listdir(base_path / "label_studio_export/images"))
+    
+    moves = []
     for annotation in annotations:
         annotation_name = annotation.split("/")[-1]
         annotation_no_extension = ".".join(annotation_name.split('.')[:-1])
         
-        os.rename(base_path / "label_studio_export/Annotations" / annotation, dest / "annotations" / annotation)
+        moves.append((base_path / "label_studio_export/Annotations" / annotation, dest / "annotations" / annotation))
         
+        # Set lookup instead of a stat() per annotation
         image_name = f"{annotation_no_extension}.png"
-        if not Path(base_path / "label_studio_export/images" / image_name).exists():
+        if image_name not in images:
             image_name = f"{annotation_no_extension}.jpg"
         
-        
-        os.rename(base_path / "label_studio_export/images" / image_name, dest / "images" / image_name)
+        moves.append((base_path / "label_studio_export/images" / image_name, dest / "images" / image_name))
+    
+    # Renames are pure I/O, so issue them from several threads; list()
+    # re-raises the first failure
+    with ThreadPoolExecutor(max_workers=16) as executor:
+        list(executor.map(lambda move: _move(*move), moves))
 
 
 if __name__ == "__main__":
     
+    source_annotations = os.listdir(base_path / "label_studio_export/Annotations")
+    source_images = set(os.listdir(base_path / "label_studio_export/images"))
     random.shuffle(source_annotations)
     
     total_annotations = len(source_annotations)
@@ -55,7 +78,7 @@ if __name__ == "__main__":
         (validation_annotations, validation_dest),
         (test_annotations, test_dest),
     ]:
-        move_files(ann, dest)
+        move_files(ann, dest, source_images)
     
     
 
@@ -1,70 +1,64 @@
-import io
-import geopandas
+import itertools
+import logging
+import queue
+import threading
+import time
 import numpy as np
 import requests
-from typing import List, Tuple
-from concurrent.futures import ThreadPoolExecutor
-from copy import deepcopy
-from PIL import Image
-
-from predict import load_model, predict
-
-import rasterio
-from rasterio.warp import transform as rio_transform
-
-
-def extract_tree_coordinates_from_prediction(
-    image_data: bytes, predictions: geopandas.GeoDataFrame
-) -> List[Tuple[float, float]]:
-    """
-    Extract geographic coordinates for detected trees from predictions in WGS 84 (EPSG:4326).
-
-    Args:
-        image_data: In-memory GeoTIFF image data in bytes.
-        predictions: GeoDataFrame containing bounding box predictions with columns:
-                     xmin, ymin, xmax, ymax (in pixel coordinates)
-
-    Returns:
-        List of tuples (longitude, latitude) representing WGS 84 coordinates of tree centers
-    """
-    coordinates = []
-
-    with rasterio.open(io.BytesIO(image_data)) as src:
-        # Get the affine transform (converts pixel coordinates to geographic coordinates)
-        transform = src.transform
-        source_crs = src.crs
-
-        print(f"Debug - Transform: {transform}")
-        print(f"Debug - Source CRS: {source_crs}")
-        print(f"Debug - Bounds: {src.bounds}")
-
-        # Process each prediction
-        for idx, pred in predictions.iterrows():
-            # Calculate center point of bounding box in pixel coordinates
-            center_col = pred["xmin"] + (pred["xmax"] - pred["xmin"]) / 2
-            center_row = pred["ymin"] + (pred["ymax"] - pred["ymin"]) / 2
-
-            # Convert pixel coordinates to source CRS geographic coordinates
-            # The * operator applies the affine transform: (geo_x, geo_y) = transform * (col, row)
-            geo_x, geo_y = transform * (center_col, center_row)
-
-            # Transform from source CRS to WGS 84 (EPSG:4326)
-            lon, lat = rio_transform(source_crs, "EPSG:4326", [geo_x], [geo_y])
-
-            if idx == 0:  # Debug first prediction
-                print(
-                    f"Debug - First prediction pixel coords: col={center_col}, row={center_row}"
-                )
-                print(
-                    f"Debug - First prediction source CRS coords: x={geo_x}, y={geo_y}"
-                )
-                print(
-                    f"Debug - First prediction WGS 84 coords: lon={lon[0]}, lat={lat[0]}"
-                )
-
-            coordinates.append((lon[0], lat[0]))
-
-    return coordinates
+from requests.adapters import HTTPAdapter
+import torch
+from typing import List
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from urllib3.util.retry import Retry
+
+from predict import load_model, pixel_to_wgs84, predict_tensor_boxes
+
+from rasterio.crs import CRS
+from rasterio.io import MemoryFile
+from rasterio.transform import from_bounds
+
+logger = logging.getLogger(__name__)
+
+# Log a progress line every this many tiles; per-tile messages are DEBUG
+PROGRESS_EVERY = 100
+_tiles_counter = itertools.count(1)
+
+# Every tile is requested at this size and CRS, which together with its
+# bbox fully determines its georeferencing
+TILE_SIZE_PX = 800
+TILE_CRS = CRS.from_epsg(25832)
+
+# Only detections at least this confident are posted; applied on the GPU
+MIN_SCORE = 0.5
+
+# Tiles per forward pass, and how long the inference worker waits for more
+# tiles before running a partial batch
+BATCH_SIZE = 16
+BATCH_TIMEOUT_S = 0.05
+
+# Trees per POST /trees/bulk request, and the longest a detection waits
+# for its batch to fill up
+POST_BATCH_SIZE = 256
+POST_FLUSH_INTERVAL_S = 0.1
+
+# One keep-alive session per download thread, so tiles reuse the TCP/TLS
+# connection to the WMS server instead of handshaking on every request
+_SESSION = threading.local()
+
+
+def _session() -> requests.Session:
+    session = getattr(_SESSION, "session", None)
+    if session is None:
+        session = requests.Session()
+        adapter = HTTPAdapter(
+            pool_connections=20,
+            pool_maxsize=20,
+            max_retries=Retry(total=3, backoff_factor=0.5),
+        )
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+        _SESSION.session = session
+    return session
 
 
 class Point:
@@ -76,41 +70,6 @@ class Point:
         return f"point_{self.x}_{self.y}"
 
 
-class Tile:
-    def __init__(self, point: Point, bbox_step: int = 80, prefix: str = "data/01_raw/florence"):
-        self.point = point
-        self.bbox_step = bbox_step
-        self.prefix = prefix
-
-    def __str__(self):
-        return f"{self.point}"
-
-    @property
-    def bbox(self):
-        return self.coordinates_to_bbox(self.point, self.bbox_step)
-
-    # def download(self, output_file: str | None = None):
-    #     if output_file is None:
-    #         output_file = f"zz_23_{self.point.x}_{self.point.y}.tif"
-
-    #     get_wms_geotiff(self.bbox, f"{self.prefix}/{output_file}")
-
-    @classmethod
-    def coordinates_to_bbox(cls, point: Point, step=80) -> list:
-        # min_x = 680012.63 - 250  # 250m to the west
-        # min_y = 4849412.92 - 250  # 250m to the south
-        # max_x = 680012.63 + 250  # 250m to the east
-        # max_y = 4849412.92 + 250  # 250m to the north
-
-        step = step / 2
-        return [
-            point.x - step,
-            point.y - step,
-            point.x + step,
-            point.y + step,
-        ]
-
-
 def get_wms_geotiff(
     bbox: List[float],
     layer: str = "rt_ofc.5k23.32bit", #for 2024/25 photos use -> "rt_ofc.5k24.32bit",
@@ -122,12 +81,12 @@ def get_wms_geotiff(
     """
     Downloads a GeoTIFF tile from a WMS service given a bounding box.
 
+    Returns the raw GeoTIFF bytes, or None if the download failed.
+
     Args:
         bbox (List[float]): The bounding box for the tile in the format
                             [minX, minY, maxX, maxY]. The coordinates must
                             be in the same CRS specified by the 'crs' param.
-        output_filepath (str): The path and filename to save the downloaded
-                               .tif file (e.g., 'my_tile.tif').
         layer (str, optional): The WMS layer to request.
                                Defaults to 'rt_ofc.5k24.32bit'.
         width (int, optional): The width of the output image in pixels.
@@ -161,11 +120,11 @@ def get_wms_geotiff(
         "TRANSPARENT": "true",
     }
 
-    print(f"Requesting 800x800 GeoTIFF for BBOX: {bbox_str}...")
+    logger.debug("Requesting 800x800 GeoTIFF for BBOX: %s", bbox_str)
 
     try:
         # Make the HTTP GET request
-        response = requests.get(base_url, params=params)
+        response = _session().get(base_url, params=params, timeout=30)
 
         # This will raise an exception if the server returns an HTTP error
         # (e.g., 404, 500)
@@ -176,93 +135,249 @@ def get_wms_geotiff(
         content_type = response.headers.get("Content-Type")
 
         if "image/tiff" in content_type:
-            # Save image file in memory without writing to disk
-            image_data = response.content
-            
-            with io.BytesIO(image_data) as img_buffer:
-                img_file = Image.open(img_buffer)
-                image = np.array(img_file.convert("RGB")).astype("float32")
-
-                results_gdf = predict(image)
-                
-                # filter out all row where score < 0.5
-                results_gdf = results_gdf[results_gdf['score'] >= 0.5]
-                
-                if not results_gdf.empty:
-                    tree_coords = extract_tree_coordinates_from_prediction(
-                        image_data, results_gdf
-                    )
-                    
-                    for i, (lon, lat) in enumerate(tree_coords, 1):
-                        prediction_row = results_gdf.iloc[i - 1]
-                        tree_data = {
-                            "latitude": lat,
-                            "longitude": lon,
-                            "source_file": f"bbox_{bbox_str}.tif",
-                            "bbox_xmin": int(prediction_row["xmin"]),
-                            "bbox_ymin": int(prediction_row["ymin"]),
-                            "bbox_xmax": int(prediction_row["xmax"]),
-                            "bbox_ymax": int(prediction_row["ymax"]),
-                        }
-                        try:
-                            post_response = requests.post(
-                                "http://localhost:8000/trees", json=tree_data
-                            )
-                            post_response.raise_for_status()
-                            print(
-                                f"Successfully posted tree {i} to API: {post_response.json()}"
-                            )
-                        except requests.exceptions.RequestException as e:
-                            print(f"Error posting tree {i} to API: {e}")
-                        
-
-        else:
-            # The server returned something other than a GeoTIFF
-            # (likely an error message)
-            print("Error: Server did not return a GeoTIFF.")
-            print(f"Response Content-Type: {content_type}")
-            print(f"Server Response (first 500 chars):\n{response.text[:500]}...")
+            # Keep the image in memory without writing to disk
+            return response.content
+
+        # The server returned something other than a GeoTIFF
+        # (likely an error message)
+        logger.warning(
+            "Server did not return a GeoTIFF for BBOX %s (Content-Type: %s): %s",
+            bbox_str,
+            content_type,
+            response.text[:500],
+        )
 
     except requests.exceptions.HTTPError as e:
         # Handle HTTP errors (e.g., 404 Not Found, 500 Internal Server Error)
-        print(f"HTTP Error: {e}")
-        print(f"Response text: {response.text}")
+        logger.warning("HTTP error for BBOX %s: %s (%s)", bbox_str, e, response.text[:500])
     except requests.exceptions.RequestException as e:
         # Handle other network-related errors (e.g., connection error)
-        print(f"An error occurred: {e}")
+        logger.warning("Request for BBOX %s failed: %s", bbox_str, e)
 
+    return None
 
-def process_tile(tile: Tile):
-    get_wms_geotiff(tile.bbox)
 
-def download_florence_tiles(start: Point, end: Point):
+def tree_records(bbox: List[float], detections: np.ndarray) -> List[dict]:
     """
-    Params:
-    start_point: tuple of (x, y) in EPSG:25832, bottom-left corner
-    end_point: tuple of (x, y) in EPSG:25832, top-right corner
+    Build the API payload for the trees detected in one tile.
+
+    `detections` is the tile's array from `predict_tensor_boxes`, already
+    filtered to MIN_SCORE.
     """
-    step_in_m = 80
+    if len(detections) == 0:
+        return []
+
+    # The GeoTIFF's own geotransform is exactly the requested bbox spread
+    # over the requested size, so there is no need to re-open the image
+    transform = from_bounds(*bbox, TILE_SIZE_PX, TILE_SIZE_PX)
+    lons, lats = pixel_to_wgs84(transform, TILE_CRS, detections[:, 5], detections[:, 6])
+    boxes = detections[:, :4].astype(int).tolist()
+    bbox_str = ",".join(map(str, bbox))
 
-    current = deepcopy(start)
+    return [
+        {
+            "latitude": lat,
+            "longitude": lon,
+            "source_file": f"bbox_{bbox_str}.tif",
+            "bbox_xmin": xmin,
+            "bbox_ymin": ymin,
+            "bbox_xmax": xmax,
+            "bbox_ymax": ymax,
+        }
+        for lon, lat, (xmin, ymin, xmax, ymax) in zip(lons.tolist(), lats.tolist(), boxes)
+    ]
+
+
+def post_trees(records: List[dict]):
+    """Send a batch of trees to the backend API in a single request."""
+    try:
+        post_response = _session().post(
+            "http://localhost:8000/trees/bulk", json=records, timeout=30
+        )
+        post_response.raise_for_status()
+        logger.debug("Posted %d trees to API", post_response.json()["created"])
+    except requests.exceptions.RequestException as e:
+        logger.warning("Error posting %d trees to API: %s", len(records), e)
 
-    tiles_to_download: list[Tile] = []
 
-    while current.y < end.y:
-        while current.x < end.x:
-            tiles_to_download.append(Tile(Point(current.x, current.y)))
-            current.x = current.x + step_in_m
-        current.y = current.y + step_in_m
-        current.x = start.x
+def process_tile(bbox: List[float], tiles_queue: queue.Queue):
+    """Download and decode one tile, then hand it to the inference worker."""
+    # next() on itertools.count is atomic under the GIL
+    tiles_done = next(_tiles_counter)
+    if tiles_done % PROGRESS_EVERY == 0:
+        logger.info("%d tiles requested", tiles_done)
 
-    with ThreadPoolExecutor(max_workers=10) as executor:
-        executor.map(process_tile, tiles_to_download)
+    image_data = get_wms_geotiff(
+        bbox, width=TILE_SIZE_PX, height=TILE_SIZE_PX, crs=TILE_CRS.to_string()
+    )
+    if image_data is None:
+        return
 
-        
+    # The tiles are 8-bit RGBA; read the colour bands straight into a
+    # (3, H, W) uint8 array, which is already the layout the model wants.
+    # Scaling to float happens on the GPU
+    with MemoryFile(image_data) as memfile, memfile.open() as src:
+        image = torch.from_numpy(src.read([1, 2, 3]))
 
+    tiles_queue.put((bbox, image))
+
+
+def inference_worker(tiles_queue: queue.Queue, results_queue: queue.Queue):
+    """
+    Single consumer owning the GPU: coalesces downloaded tiles into batches
+    of up to BATCH_SIZE and runs them through the detector together,
+    instead of one forward pass per tile. Detections are handed off to the
+    poster so the GPU never waits on the API.
+    """
+    # One page-locked staging buffer reused for every batch instead of
+    # pinning a fresh tensor each time. Reuse is safe because
+    # predict_tensor_boxes ends with a device-to-host copy, which waits for
+    # the previous batch's host-to-device copy out of this buffer
+    pinned = None
+    if torch.cuda.is_available():
+        pinned = torch.empty(
+            (BATCH_SIZE, 3, TILE_SIZE_PX, TILE_SIZE_PX), dtype=torch.uint8, pin_memory=True
+        )
+
+    done = False
+    while not done:
+        batch = [tiles_queue.get()]
+        # Top the batch up with whatever else arrives shortly; a partial
+        # batch is better than idling the GPU while downloads trickle in
+        while len(batch) < BATCH_SIZE:
+            try:
+                batch.append(tiles_queue.get(timeout=BATCH_TIMEOUT_S))
+            except queue.Empty:
+                break
+
+        if batch[-1] is None:
+            batch.pop()
+            done = True
+        if not batch:
+            break
+
+        # One tile of the wrong size or type would make the stack, and so
+        # the whole batch, fail; drop just that tile
+        valid = []
+        for bbox, image in batch:
+            if image.shape == (3, TILE_SIZE_PX, TILE_SIZE_PX) and image.dtype == torch.uint8:
+                valid.append((bbox, image))
+            else:
+                logger.warning(
+                    "Skipping tile %s: %s %s image", bbox, tuple(image.shape), image.dtype
+                )
+        batch = valid
+        if not batch:
+            continue
+
+        try:
+            images = [image for _, image in batch]
+            if pinned is not None:
+                images = torch.stack(images, out=pinned[: len(images)])
+            else:
+                images = torch.stack(images)
+            predictions = predict_tensor_boxes(images, min_score=MIN_SCORE)
+        except Exception:
+            # Keep consuming, otherwise the downloaders block on the full queue
+            logger.exception("Error running inference on %d tiles", len(batch))
+            continue
+
+        for (bbox, _), detections in zip(batch, predictions):
+            results_queue.put((bbox, detections))
+
+
+def poster_worker(results_queue: queue.Queue):
+    """
+    Post detections to the API until the None sentinel arrives. Trees from
+    consecutive tiles are sent together, once POST_BATCH_SIZE of them are
+    pending or the oldest has waited POST_FLUSH_INTERVAL_S.
+    """
+    pending: List[dict] = []
+    flush_at = 0.0
+    done = False
+    while not done:
+        timeout = max(0.0, flush_at - time.monotonic()) if pending else None
+        try:
+            item = results_queue.get(timeout=timeout)
+            if item is None:
+                done = True
+            else:
+                if not pending:
+                    flush_at = time.monotonic() + POST_FLUSH_INTERVAL_S
+                pending.extend(tree_records(*item))
+        except queue.Empty:
+            pass
+        except Exception:
+            # Keep draining, otherwise the inference worker blocks on the
+            # full results queue
+            logger.exception("Error building tree records for tile %s", item[0])
+
+        if pending and (
+            done or len(pending) >= POST_BATCH_SIZE or time.monotonic() >= flush_at
+        ):
+            try:
+                post_trees(pending)
+            except Exception:
+                logger.exception("Error posting %d trees to API", len(pending))
+            pending = []
+
+
+def download_florence_tiles(start: Point, end: Point):
+    """
+    Params:
+    start_point: tuple of (x, y) in EPSG:25832, bottom-left corner
+    end_point: tuple of (x, y) in EPSG:25832, top-right corner
+    """
+    step_in_m = 80
+    half_step = step_in_m / 2
+
+    # Row-major grid of tile centers, bottom row first, and the
+    # [minX, minY, maxX, maxY] bbox of every tile, all in one go
+    xx, yy = np.meshgrid(
+        np.arange(start.x, end.x, step_in_m), np.arange(start.y, end.y, step_in_m)
+    )
+    cx, cy = xx.ravel(), yy.ravel()
+    bboxes = np.column_stack(
+        [cx - half_step, cy - half_step, cx + half_step, cy + half_step]
+    ).tolist()
+    logger.info("Scraping %d tiles", len(bboxes))
+
+    # Three overlapping stages: the thread pool downloads, one thread runs
+    # inference and one posts the results. The queues are bounded so no
+    # stage can run arbitrarily far ahead of the next one
+    tiles_queue: queue.Queue = queue.Queue(maxsize=2 * BATCH_SIZE)
+    results_queue: queue.Queue = queue.Queue(maxsize=4 * BATCH_SIZE)
+    worker = threading.Thread(target=inference_worker, args=(tiles_queue, results_queue))
+    poster = threading.Thread(target=poster_worker, args=(results_queue,))
+    worker.start()
+    poster.start()
+
+    # The thread pool is now only used for the HTTP downloads
+    failed = 0
+    with ThreadPoolExecutor(max_workers=10) as executor:
+        futures = {executor.submit(process_tile, bbox, tiles_queue): bbox for bbox in bboxes}
+        # Collect the results, otherwise a tile that fails to decode is
+        # dropped without a trace
+        for future in as_completed(futures):
+            try:
+                future.result()
+            except Exception as e:
+                failed += 1
+                logger.warning("Tile %s failed: %s", futures[future], e)
+
+    if failed:
+        logger.warning("%d of %d tiles failed", failed, len(bboxes))
+
+    # Sentinels: no more tiles, then no more results
+    tiles_queue.put(None)
+    worker.join()
+    results_queue.put(None)
+    poster.join()
 
 
 if __name__ == "__main__":
-    
+    logging.basicConfig(level=logging.INFO)
+
     model = load_model() #for warming up the model before downloading tiles
     
     
@@ -9,15 +9,72 @@ from pathlib import Path
 import pandas as pd
 from config import load_config
 import torch
-from deepforest import main
-from deepforest import get_data
-import matplotlib.pyplot as plt
-from pytorch_lightning.callbacks import ModelCheckpoint
+from PIL import Image
+from forest_model import DeepForest, load_weights, save_weights
+from pytorch_lightning.callbacks import Callback, EarlyStopping, ModelCheckpoint
+from pytorch_lightning.utilities import rank_zero_only
+
+BAR = "=" * 50
+WIDE_BAR = "=" * 70
+
+# Set from --quiet by main_pipeline
+VERBOSE = True
+
+
+@rank_zero_only
+def info(*args):
+    """print() for progress messages: off with --quiet and on every DDP rank but 0."""
+    if VERBOSE:
+        print(*args)
+
+
+ANNOTATION_DTYPES = {
+    'image_path': 'string',
+    'xmin': 'int32',
+    'ymin': 'int32',
+    'xmax': 'int32',
+    'ymax': 'int32',
+    'label': 'category',
+}
+
+
+def _read_annotations(csv_file, name):
+    """Read only the annotation columns, with compact dtypes, and check none is missing."""
+    # A callable usecols skips extra columns without failing on missing ones,
+    # so the error below can name them
+    df = pd.read_csv(csv_file, usecols=lambda col: col in ANNOTATION_DTYPES, dtype=ANNOTATION_DTYPES)
+    missing = set(ANNOTATION_DTYPES) - set(df.columns)
+    if missing:
+        raise ValueError(f"{name} CSV missing required columns: {', '.join(sorted(missing))}")
+    return df
+
+
+def _image_sizes(df, root_dir):
+    """Set of distinct (width, height) of the images an annotations frame refers to."""
+    sizes = set()
+    for image_path in df['image_path'].unique():
+        # Image.open only parses the header, the pixels are never decoded
+        with Image.open(os.path.join(root_dir, image_path)) as image:
+            sizes.add(image.size)
+    return sizes
+
+
+class CombinedLossLogger(Callback):
+    """
+    Log val_loss, the sum of the classification and box-regression
+    validation losses deepforest logs separately, so it can be monitored.
+    """
+
+    def on_validation_epoch_end(self, trainer, pl_module):
+        metrics = trainer.callback_metrics
+        if "val_classification" in metrics and "val_bbox_regression" in metrics:
+            # Tensor add, no .item(): the sum stays on the metrics' device
+            combined = torch.add(metrics["val_classification"], metrics["val_bbox_regression"])
+            # deepforest already logs the two components, so this is the only
+            # extra metric (and, with sync_dist under DDP, the only extra
+            # all-reduce); it is the one worth showing in the progress bar
+            pl_module.log_dict({"val_loss": combined}, prog_bar=True, logger=True, sync_dist=True)
 
-config = load_config()
-train_config = config["training"]
-model_config = config["model"]
-data_config = config["data"]
 
 def load_and_validate_data(train_csv, val_csv):
     """
@@ -26,25 +83,17 @@ def load_and_validate_data(train_csv, val_csv):
     Expected CSV format:
     image_path, xmin, ymin, xmax, ymax, label
     """
-    print("\n" + "="*50)
-    print("Loading and validating data...")
-    print("="*50)
-    
-    # Load CSVs
-    train_df = pd.read_csv(train_csv)
-    val_df = pd.read_csv(val_csv)
-    
-    # Validate required columns
-    required_columns = ['image_path', 'xmin', 'ymin', 'xmax', 'ymax', 'label']
-    for col in required_columns:
-        if col not in train_df.columns:
-            raise ValueError(f"Training CSV missing required column: {col}")
-        if col not in val_df.columns:
-            raise ValueError(f"Validation CSV missing required column: {col}")
-    
-    print(f"✓ Training data: {len(train_df)} annotations, {train_df['image_path'].nunique()} images")
-    print(f"✓ Validation data: {len(val_df)} annotations, {val_df['image_path'].nunique()} images")
-    print(f"✓ Classes: {train_df['label'].unique()}")
+    info("\n" + BAR)
+    info("Loading and validating data...")
+    info(BAR)
+    
+    # Load CSVs and validate required columns
+    train_df = _read_annotations(train_csv, "Training")
+    val_df = _read_annotations(val_csv, "Validation")
+    
+    info(f"✓ Training data: {len(train_df)} annotations, {train_df['image_path'].nunique()} images")
+    info(f"✓ Validation data: {len(val_df)} annotations, {val_df['image_path'].nunique()} images")
+    info(f"✓ Classes: {train_df['label'].unique()}")
     
     return train_df, val_df
 
@@ -56,20 +105,24 @@ def create_model(config):
     Args:
         config: Dictionary with model configuration
     """
-    print("\n" + "="*50)
-    print("Creating DeepForest model...")
-    print("="*50)
+    info("\n" + BAR)
+    info("Creating DeepForest model...")
+    info(BAR)
     
-    model = main.deepforest()
+    model = DeepForest()
     
     # Load pretrained weights if specified
     # model.load_model(model_name="weecology/deepforest-tree", revision="main")
     
     # Load pretrained data with old weights 
-    model.model = torch.load(
-        model_config["final_model_path"],
-        weights_only=False
-    )
+    load_weights(model, config['init_model_path'])
+    
+    if config.get('compile') and torch.cuda.is_available():
+        # Only the ResNet+FPN backbone: anchor matching, the losses and NMS
+        # are data dependent and would just graph-break. The first steps
+        # pay the compile cost
+        model.model.backbone = torch.compile(model.model.backbone)
+        info("✓ Backbone compiled with torch.compile")
     
     # Configure model
     model.config["train"]["csv_file"] = config['train_csv']
@@ -84,10 +137,10 @@ def create_model(config):
     model.config["train"]["lr"] = config.get('learning_rate', 0.0001)
     model.config["train"]["scheduler"] = {
         "type": "reduce_on_plateau",
-        "monitor": "map",
+        "monitor": config.get('val_loss_monitor', 'val_loss'),
         "params": {
             "patience": 3,
-            "mode": "max",
+            "mode": "min",
             "factor": 0.1,
             "threshold": 0.0001,
             "threshold_mode": "rel",
@@ -101,12 +154,16 @@ def create_model(config):
     
     # Set number of workers for data loading
     model.config["workers"] = config.get('num_workers', 4)
+    # Pinned memory only helps CUDA copies; it costs RAM on MPS/CPU
+    model.config["train"]["pin_memory"] = torch.cuda.is_available()
+    # Don't re-spawn (and re-import deepforest in) the workers every epoch
+    model.config["train"]["persistent_workers"] = True
     
-    print(f"✓ Batch size: {model.config['batch_size']}")
-    print(f"✓ Epochs: {model.config['train']['epochs']}")
-    print(f"✓ Learning rate: {model.config['train']['lr']}")
-    print(f"✓ Score threshold: {model.config['score_thresh']}")
-    print(f"✓ NMS threshold: {model.config['nms_thresh']}")
+    info(f"✓ Batch size: {model.config['batch_size']}")
+    info(f"✓ Epochs: {model.config['train']['epochs']}")
+    info(f"✓ Learning rate: {model.config['train']['lr']}")
+    info(f"✓ Score threshold: {model.config['score_thresh']}")
+    info(f"✓ NMS threshold: {model.config['nms_thresh']}")
     
     return model
 
@@ -119,13 +176,12 @@ def train_model(model, config):
         model: DeepForest model instance
         config: Dictionary with training configuration
     """
-    print("\n" + "="*50)
-    print("Starting training...")
-    print("="*50)
+    info("\n" + BAR)
+    info("Starting training...")
+    info(BAR)
     
     # Setup checkpoint callback to save best model
-    output_dir = Path(config.get('output_dir', 'models'))
-    output_dir.mkdir(parents=True, exist_ok=True)
+    output_dir = config['output_dir_path']
     
     checkpoint_callback = ModelCheckpoint(
         dirpath=str(output_dir),
@@ -140,30 +196,79 @@ def train_model(model, config):
     trainer_args = {
         "fast_dev_run": config.get('fast_dev_run', False),
         "max_epochs": config.get('epochs', 20),
-        "callbacks": [checkpoint_callback],
+        "callbacks": [
+            checkpoint_callback,
+            CombinedLossLogger(),
+            # Stop once the validation loss has plateaued instead of always
+            # running every epoch
+            EarlyStopping(monitor=config.get('val_loss_monitor', 'val_loss'), patience=5, mode='min'),
+        ],
+        # Effective batch of batch_size * accum_steps at the memory cost of
+        # batch_size, with one optimizer step per accum_steps batches
+        "accumulate_grad_batches": config.get('accum_steps', 4),
     }
     
     # Add GPU support if available
     if torch.cuda.is_available():
-        print(f"✓ Training on GPU: {torch.cuda.get_device_name(0)}")
+        if VERBOSE:
+            # get_device_name is an NVML query; skip it when quiet
+            info(f"✓ Training on GPU: {torch.cuda.get_device_name(0)}")
         trainer_args["accelerator"] = "gpu"
-        trainer_args["devices"] = 1
-    else:
-        print("✓ Training on CPU/MPS")
+        trainer_args["devices"] = torch.cuda.device_count()
+        if trainer_args["devices"] > 1:
+            # One process per GPU with gradient all-reduce; batch_size is
+            # per device. Lightning re-launches this script for every rank
+            trainer_args["strategy"] = "ddp"
+            info(f"✓ DDP across {trainer_args['devices']} GPUs")
+        
+        # Mixed precision: bf16 on Ampere and newer (same range as fp32, no
+        # loss scaling), fp16 with Lightning's gradient scaler on older GPUs
+        if torch.cuda.get_device_capability()[0] >= 8:
+            trainer_args["precision"] = "bf16-mixed"
+        else:
+            trainer_args["precision"] = "16-mixed"
+        # Let the matmuls left in fp32 use TF32 tensor cores
+        torch.set_float32_matmul_precision("high")
+        # cuDNN autotuning pays off only if every batch has the same shape:
+        # it re-tunes each conv for every new input size. Runs need not be
+        # bitwise reproducible
+        torch.backends.cudnn.benchmark = config.get('uniform_image_size', False)
+        torch.backends.cudnn.deterministic = False
+        info(f"✓ Precision: {trainer_args['precision']}")
+        info(f"✓ cuDNN benchmark: {torch.backends.cudnn.benchmark}")
+    elif torch.backends.mps.is_available():
+        info("✓ Training on MPS")
         trainer_args["accelerator"] = "mps"
+        # Forked dataloader workers are unstable alongside MPS
+        model.config["workers"] = 0
+    else:
+        info("✓ Training on CPU")
+        trainer_args["accelerator"] = "cpu"
+        # Leave cores for the dataloader workers instead of oversubscribing
+        # them with OpenMP threads
+        torch.set_num_threads(max(1, os.cpu_count() // 2))
+        torch.set_num_interop_threads(2)
     
     # Train the model
     model.create_trainer(**trainer_args)
     model.trainer.fit(model)
     
-    print("\n✓ Training completed!")
-    print(f"✓ Best model saved to: {checkpoint_callback.best_model_path}")
+    # Under DDP only rank 0 reports, reloads and (in main_pipeline) saves
+    if not model.trainer.is_global_zero:
+        return None
+    
+    info("\n✓ Training completed!")
+    info(f"✓ Best model saved to: {checkpoint_callback.best_model_path}")
     
     # Load the best model weights
     best_model_path = checkpoint_callback.best_model_path
     if best_model_path and os.path.exists(best_model_path):
-        print(f"✓ Loading best model from: {best_model_path}")
-        checkpoint = torch.load(best_model_path)
+        info(f"✓ Loading best model from: {best_model_path}")
+        # Straight to CPU: load_state_dict copies into the live parameters,
+        # so a second full copy of the weights on the GPU is never needed.
+        # The Lightning checkpoint is plain tensors and containers, so the
+        # restricted unpickler is enough
+        checkpoint = torch.load(best_model_path, map_location="cpu", weights_only=True)
         model.load_state_dict(checkpoint['state_dict'])
     
     return best_model_path
@@ -177,48 +282,44 @@ def evaluate_model(model, config):
         model: Trained DeepForest model
         config: Dictionary with evaluation configuration
     """
-    print("\n" + "="*50)
-    print("Evaluating model...")
-    print("="*50)
-    
-    # Save original batch size and set to 1 for evaluation to avoid collation issues
-    # Images may have different sizes, and batch_size > 1 causes tensor stacking errors
-    original_batch_size = model.config["batch_size"]
-    model.config["batch_size"] = 1
-    
-    # Run evaluation
+    info("\n" + BAR)
+    info("Evaluating model...")
+    info(BAR)
+    
+    # model.evaluate predicts through model.trainer. Under DDP only rank 0
+    # gets this far, and the DDP trainer would block at its setup barrier
+    # waiting for the ranks that already returned, so predict on one device
+    if model.trainer.world_size > 1:
+        model.create_trainer(devices=1, strategy="auto", callbacks=[])
+    
+    # Run evaluation with the training batch size: DeepForest's
+    # predict_dataloader collates images into a list, which RetinaNet pads
+    # and batches itself, so differently sized images need no batch_size=1
     results = model.evaluate(
         csv_file=config['val_csv'],
         root_dir=config.get('val_root_dir', os.path.dirname(config['val_csv'])),
         iou_threshold=config.get('iou_threshold', 0.4)
     )
     
-    # Restore original batch size
-    model.config["batch_size"] = original_batch_size
-    
-    print("\nEvaluation Results:")
-    print("-" * 50)
+    # Format once, for both the console and the results file
+    lines = []
     if results is not None:
         for key, value in results.items():
             if isinstance(value, (int, float)):
-                print(f"{key}: {value:.4f}")
+                lines.append(f"{key}: {value:.4f}")
             else:
-                print(f"{key}:")
-                print(value)
+                lines.append(f"{key}:\n{value}\n")
+    report = "\n".join(lines)
+    
+    print("\nEvaluation Results:")
+    print("-" * 50)
+    print(report)
     
     # Save results
-    results_file = Path(config.get('output_dir', 'results')) / 'evaluation_results.txt'
-    with open(results_file, 'w') as f:
-        f.write("DeepForest Evaluation Results\n")
-        f.write("="*50 + "\n")
-        if results is not None:
-            for key, value in results.items():
-                if isinstance(value, (int, float)):
-                    f.write(f"{key}: {value:.4f}\n")
-                else:
-                    f.write(f"{key}:\n{value}\n\n")
-    
-    print(f"\n✓ Results saved to {results_file}")
+    results_file = config['output_dir_path'] / 'evaluation_results.txt'
+    results_file.write_text("DeepForest Evaluation Results\n" + BAR + "\n" + report + "\n")
+    
+    info(f"\n✓ Results saved to {results_file}")
     
     return results
 
@@ -231,34 +332,37 @@ def save_model(model, config):
         model: Trained DeepForest model (already loaded with best weights)
         config: Dictionary with save configuration
     """
-    print("\n" + "="*50)
-    print("Saving model...")
-    print("="*50)
+    info("\n" + BAR)
+    info("Saving model...")
+    info(BAR)
     
-    output_dir = Path(config.get('output_dir', 'models'))
-    output_dir.mkdir(parents=True, exist_ok=True)
-
-    existing_models = len(os.listdir(output_dir))
+    output_dir = config['output_dir_path']
 
-    # to save the model with version, not only the default name
-    model_path = output_dir / f"deepforest_finetuned_{existing_models}.pt"
+    # to save the model with version, not only the default name: one past
+    # the highest existing version, ignoring checkpoints and other files
+    versions = [
+        int(version)
+        for version in (path.stem.rsplit("_", 1)[-1] for path in output_dir.glob("deepforest_finetuned_*.pt"))
+        if version.isdigit()
+    ]
+    model_path = output_dir / f"deepforest_finetuned_{max(versions, default=-1) + 1}.pt"
     
     # Save model state dict
-    torch.save(model.model, model_path)
+    save_weights(model, model_path)
     
-    print(f"✓ Model (best weights) saved to {model_path}")
+    info(f"✓ Model (best weights) saved to {model_path}")
     if config.get('best_model_path'):
-        print(f"✓ PyTorch Lightning checkpoint also available at: {config['best_model_path']}")
+        info(f"✓ PyTorch Lightning checkpoint also available at: {config['best_model_path']}")
     
     # Save configuration
     config_path = output_dir / 'config.txt'
     with open(config_path, 'w') as f:
         f.write("DeepForest Training Configuration\n")
-        f.write("="*50 + "\n")
+        f.write(BAR + "\n")
         for key, value in config.items():
             f.write(f"{key}: {value}\n")
     
-    print(f"✓ Configuration saved to {config_path}")
+    info(f"✓ Configuration saved to {config_path}")
 
 
 def main_pipeline(args):
@@ -268,9 +372,18 @@ def main_pipeline(args):
     Args:
         args: Command line arguments
     """
-    print("\n" + "="*70)
-    print(" " * 15 + "DeepForest Fine-tuning Pipeline")
-    print("="*70)
+    global VERBOSE
+    VERBOSE = not args.quiet
+    
+    info("\n" + WIDE_BAR)
+    info(" " * 15 + "DeepForest Fine-tuning Pipeline")
+    info(WIDE_BAR)
+    
+    # Read config.yml here rather than at import time, so importing this
+    # module has no side effects
+    project_config = load_config()
+    train_config = project_config["training"]
+    model_config = project_config["model"]
     
     training_data = train_config["training_data"]
     training_annotations = train_config["training_annotations"]
@@ -293,28 +406,41 @@ def main_pipeline(args):
         'output_dir': args.output_dir,
         'model_name': args.model_name,
         'iou_threshold': args.iou_threshold,
-        'fast_dev_run': False,
+        'compile': args.compile,
+        'val_loss_monitor': train_config.get("val_loss_monitor", "val_loss"),
+        'init_model_path': model_config["final_model_path"],
+        'accum_steps': args.accum_steps,
+        'fast_dev_run': args.fast_dev_run,
     }
     
+    # Models, checkpoints and results all go to one directory; create it once
+    config['output_dir_path'] = Path(args.output_dir)
+    config['output_dir_path'].mkdir(parents=True, exist_ok=True)
+    
     # Load and validate data
     train_df, val_df = load_and_validate_data(training_annotations, validation_annotations)
+    config['uniform_image_size'] = len(
+        _image_sizes(train_df, training_data) | _image_sizes(val_df, validation_data)
+    ) == 1
     
     # Create model
     model = create_model(config)
     
     # Train model (returns path to best model checkpoint)
     best_model_path = train_model(model, config)
+    if not model.trainer.is_global_zero:
+        return
     config['best_model_path'] = best_model_path
     
-    # Evaluate model (now using best weights)
-    # evaluate_model(model, config)
+    # Evaluate model (now using best weights); rank 0 only, on a single device
+    evaluate_model(model, config)
     
     # Save final model with custom name
     save_model(model, config)
     
-    print("\n" + "="*70)
-    print(" " * 20 + "Pipeline completed successfully!")
-    print("="*70 + "\n")
+    info("\n" + WIDE_BAR)
+    info(" " * 20 + "Pipeline completed successfully!")
+    info(WIDE_BAR + "\n")
 
 
 if __name__ == "__main__":
@@ -352,6 +478,12 @@ if __name__ == "__main__":
         default=20,
         help='Number of training epochs'
     )
+    parser.add_argument(
+        '--accum-steps',
+        type=int,
+        default=4,
+        help='Batches to accumulate gradients over before each optimizer step'
+    )
     parser.add_argument(
         '--learning-rate',
         type=float,
@@ -377,6 +509,12 @@ if __name__ == "__main__":
         help='Number of data loading workers'
     )
     
+    parser.add_argument(
+        '--compile',
+        action='store_true',
+        help='torch.compile the backbone (CUDA only); pays off on long runs'
+    )
+    
     # Evaluation arguments
     parser.add_argument(
         '--iou-threshold',
@@ -399,6 +537,12 @@ if __name__ == "__main__":
         help='Name for saved model file'
     )
     
+    parser.add_argument(
+        '--quiet',
+        action='store_true',
+        help='Only print the evaluation results and errors'
+    )
+    
     # Debug arguments
     parser.add_argument(
         '--fast-dev-run',